@@ -0,0 +1,231 @@
+"""
+DEFLATE block codec shared by the compressors
+
+libdeflate is used through ctypes whenever the shared library can be loaded,
+it is considerably faster than zlib on small, fixed size, non-streaming blocks
+like the ones in CSO files. Otherwise this falls back to zlib-ng (if
+installed) and finally the stdlib zlib module. All of the backends raise
+zlib.error on bad data so callers don't need to care which one is in use.
+"""
+
+import ctypes
+import ctypes.util
+import threading
+import zlib
+
+try:
+    from zlib_ng import zlib_ng as _zlib
+except ImportError:
+    _zlib = zlib
+
+LIBDEFLATE_NAMES    = ['libdeflate.so.0', 'libdeflate.dylib', 'libdeflate.dll']
+LIBDEFLATE_SUCCESS  = 0
+# spare output space libdeflate needs before it reports a stream as fitting
+LIBDEFLATE_HEADROOM = 16
+# deflate window sizes zlib accepts for raw streams
+WINDOW_BITS_MIN     = 9
+WINDOW_BITS_MAX     = 15
+
+def _load_libdeflate():
+    names = LIBDEFLATE_NAMES
+    found = ctypes.util.find_library('deflate')
+    if found is not None:
+        names = [found] + names
+    for name in names:
+        try:
+            lib = ctypes.CDLL(name)
+        except OSError:
+            continue
+
+        lib.libdeflate_alloc_compressor.argtypes = [ctypes.c_int]
+        lib.libdeflate_alloc_compressor.restype = ctypes.c_void_p
+        lib.libdeflate_free_compressor.argtypes = [ctypes.c_void_p]
+        lib.libdeflate_free_compressor.restype = None
+        lib.libdeflate_deflate_compress_bound.argtypes = [ctypes.c_void_p,
+            ctypes.c_size_t]
+        lib.libdeflate_deflate_compress_bound.restype = ctypes.c_size_t
+        lib.libdeflate_deflate_compress.argtypes = [ctypes.c_void_p,
+            ctypes.c_void_p, ctypes.c_size_t, ctypes.c_void_p, ctypes.c_size_t]
+        lib.libdeflate_deflate_compress.restype = ctypes.c_size_t
+
+        lib.libdeflate_alloc_decompressor.argtypes = []
+        lib.libdeflate_alloc_decompressor.restype = ctypes.c_void_p
+        lib.libdeflate_free_decompressor.argtypes = [ctypes.c_void_p]
+        lib.libdeflate_free_decompressor.restype = None
+        lib.libdeflate_deflate_decompress.argtypes = [ctypes.c_void_p,
+            ctypes.c_void_p, ctypes.c_size_t, ctypes.c_void_p, ctypes.c_size_t,
+            ctypes.POINTER(ctypes.c_size_t)]
+        lib.libdeflate_deflate_decompress.restype = ctypes.c_int
+        lib.libdeflate_zlib_decompress.argtypes = \
+            lib.libdeflate_deflate_decompress.argtypes
+        lib.libdeflate_zlib_decompress.restype = ctypes.c_int
+        return lib
+    return None
+
+_libdeflate = _load_libdeflate()
+
+class _LibdeflateState(object):
+    """A libdeflate (de)compressor plus its output buffer, owned by a single
+    thread and reused for every block that thread handles
+    """
+    def __init__(self, handle, free):
+        self.handle = handle
+        self._free = free
+        self.output = ctypes.create_string_buffer(0)
+        self.actual_size = ctypes.c_size_t()
+        self.actual_size_ref = ctypes.byref(self.actual_size)
+
+    def output_buffer(self, size):
+        if len(self.output) < size:
+            self.output = ctypes.create_string_buffer(size)
+        return self.output
+
+    def __del__(self):
+        try:
+            self._free(self.handle)
+        except Exception:
+            # the library may already be gone at interpreter shutdown
+            pass
+
+_thread_state = threading.local()
+
+def _as_bytes(data):
+    # ctypes can only hand out pointers to bytes, so views of the input
+    # mappings are copied here. that's the one copy a block gets on its way
+    # through libdeflate, and for blocks this small it's cheaper than wrapping
+    # a writable view with from_buffer
+    if isinstance(data, bytes):
+        return data
+    if isinstance(data, memoryview):
+        return data.tobytes()
+    return bytes(data)
+
+def _compressor(level):
+    compressors = getattr(_thread_state, 'compressors', None)
+    if compressors is None:
+        compressors = _thread_state.compressors = {}
+    try:
+        return compressors[level]
+    except KeyError:
+        handle = _libdeflate.libdeflate_alloc_compressor(level)
+        if not handle:
+            raise zlib.error('libdeflate: invalid compression level %d' % level)
+        state = compressors[level] = _LibdeflateState(handle,
+            _libdeflate.libdeflate_free_compressor)
+        return state
+
+def _decompressor():
+    state = getattr(_thread_state, 'decompressor', None)
+    if state is None:
+        handle = _libdeflate.libdeflate_alloc_decompressor()
+        if not handle:
+            raise MemoryError('libdeflate: could not allocate a decompressor')
+        state = _thread_state.decompressor = _LibdeflateState(handle,
+            _libdeflate.libdeflate_free_decompressor)
+    return state
+
+if _libdeflate is not None:
+    BACKEND = 'libdeflate'
+    _deflate_compress_bound = _libdeflate.libdeflate_deflate_compress_bound
+    _deflate_compress = _libdeflate.libdeflate_deflate_compress
+    _deflate_decompress = _libdeflate.libdeflate_deflate_decompress
+    _zlib_decompress = _libdeflate.libdeflate_zlib_decompress
+
+    def _inflate(decompress, data, size):
+        # the thread's decompressor and output buffer are reused across calls,
+        # there's no per-block setup left besides the call itself
+        data = _as_bytes(data)
+        state = _decompressor()
+        output = state.output_buffer(size)
+        result = decompress(state.handle, data, len(data), output, size,
+            state.actual_size_ref)
+        if result != LIBDEFLATE_SUCCESS:
+            raise zlib.error('libdeflate: error %d while decompressing data' % result)
+        return ctypes.string_at(output, state.actual_size.value)
+
+    def deflate(data, level, limit=None):
+        """Compress data into a raw DEFLATE stream, or return None if limit is
+        given and the stream would not come out shorter than limit bytes
+        """
+        data = _as_bytes(data)
+        state = _compressor(level)
+        bound = _deflate_compress_bound(state.handle, len(data))
+        output = state.output_buffer(bound)
+        if limit is not None:
+            # libdeflate stops emitting as soon as the output runs past the
+            # space it was given, but it also gives up on streams that would
+            # fit with only a few bytes to spare, so leave it some headroom
+            # and make the exact decision here
+            size = _deflate_compress(state.handle, data, len(data), output,
+                min(bound, limit + LIBDEFLATE_HEADROOM))
+            return ctypes.string_at(output, size) if 0 < size < limit else None
+        size = _deflate_compress(state.handle, data, len(data), output, bound)
+        if not size:
+            raise zlib.error('libdeflate: compressed data did not fit its bound')
+        return ctypes.string_at(output, size)
+
+    def inflate(data, size):
+        """Decompress a raw DEFLATE stream that inflates to at most size bytes,
+        anything after the end of the stream is ignored
+        """
+        return _inflate(_deflate_decompress, data, size)
+
+    def zlib_inflate(data, size):
+        """Decompress a zlib wrapped stream that inflates to at most size bytes,
+        checking its adler32 trailer
+        """
+        return _inflate(_zlib_decompress, data, size)
+else:
+    BACKEND = _zlib.__name__
+
+    def _decompress(data, window_bits, size):
+        try:
+            # zlib.decompress only takes size as a starting buffer size, a
+            # decompressobj can actually be held to it
+            decompressor = _zlib.decompressobj(window_bits)
+            output = decompressor.decompress(data, size)
+        except _zlib.error as err:
+            # zlib-ng raises its own error type, which isn't a zlib.error
+            raise zlib.error(str(err))
+        if not decompressor.eof:
+            raise zlib.error('Error while decompressing data: truncated '
+                'stream or more than %d bytes of output' % size)
+        return output
+
+    def deflate(data, level, limit=None):
+        """Compress data into a raw DEFLATE stream, or return None if limit is
+        given and the stream would not come out shorter than limit bytes
+        """
+        # ask for raw deflate instead of slicing the header off of a zlib
+        # stream, with a window just big enough to cover the whole block
+        # since nothing outside of it can be referenced anyway
+        window_bits = max(WINDOW_BITS_MIN, min(WINDOW_BITS_MAX,
+            len(data).bit_length()))
+        try:
+            compressor = _zlib.compressobj(level, _zlib.DEFLATED, -window_bits)
+            # zlib holds a small block's output back until the final flush and
+            # forcing it out early would change the stream, so the limit can
+            # only be checked once it's done
+            compressed = compressor.compress(data) + compressor.flush()
+        except _zlib.error as err:
+            raise zlib.error(str(err))
+        if limit is not None and len(compressed) >= limit:
+            return None
+        return compressed
+
+    def inflate(data, size):
+        """Decompress a raw DEFLATE stream that inflates to at most size bytes,
+        anything after the end of the stream is ignored
+        """
+        return _decompress(data, -WINDOW_BITS_MAX, size)
+
+    def zlib_inflate(data, size):
+        """Decompress a zlib wrapped stream that inflates to at most size bytes,
+        checking its adler32 trailer
+        """
+        return _decompress(data, WINDOW_BITS_MAX, size)
+
+# a stream right at the limit has to be accepted, whichever backend is in use
+_sample = bytes(range(256)) * 8
+assert deflate(_sample, 1, len(deflate(_sample, 1)) + 1) is not None
+del _sample
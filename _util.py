@@ -0,0 +1,136 @@
+"""
+Block I/O and threading helpers shared by the CSO and GCZ tools
+"""
+
+import os
+import mmap
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+# how far ahead of the current block to ask the kernel to prefetch input
+READAHEAD_SIZE      = 8 << 20
+
+def buffer_view(data, offset, size):
+    return memoryview(data)[offset:offset + size]
+
+def readahead_hint(fd):
+    """Mark fd for sequential access and build a hint(offset) function that
+    keeps the kernel reading about READAHEAD_SIZE bytes past offset. Returns
+    None where posix_fadvise isn't available.
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return None
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    except OSError:
+        return None
+    # only issue a new hint once half of the last window has been consumed,
+    # rather than one syscall per block
+    hinted_until = [0]
+    def hint(offset):
+        if offset + READAHEAD_SIZE // 2 > hinted_until[0]:
+            start = max(offset, hinted_until[0])
+            os.posix_fadvise(fd, start, READAHEAD_SIZE, os.POSIX_FADV_WILLNEED)
+            hinted_until[0] = start + READAHEAD_SIZE
+    return hint
+
+def positional_reader(handle):
+    """Build a read(offset, size) function for handle, preferring an mmap view
+    of the file, then os.pread, and only falling back to seek+read (serialized
+    by a lock) for handles without a usable file descriptor. The reader is
+    safe to share between threads. handle has to be seekable, see
+    sequential_reader for pipes and the like.
+    """
+    try:
+        # pipes have a descriptor too, but neither mmap nor pread work on them
+        fd = handle.fileno() if handle.seekable() else None
+    except (AttributeError, EnvironmentError, ValueError):
+        fd = None
+    if fd is not None:
+        read = None
+        try:
+            view = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        except (EnvironmentError, ValueError):
+            view = None
+        if view is not None:
+            if hasattr(view, 'madvise'):
+                view.madvise(mmap.MADV_SEQUENTIAL)
+            # hand out views of the mapping rather than copying every block
+            read = lambda offset, size: buffer_view(view, offset, size)
+        elif hasattr(os, 'pread'):
+            read = lambda offset, size: os.pread(fd, size, offset)
+        if read is not None:
+            hint = readahead_hint(fd)
+            if hint is None:
+                return read
+            def read_ahead(offset, size):
+                hint(offset + size)
+                return read(offset, size)
+            return read_ahead
+    lock = threading.Lock()
+    def read(offset, size):
+        with lock:
+            handle.seek(offset)
+            return handle.read(size)
+    return read
+
+def sequential_reader(handle, position=0):
+    """Build a read(offset, size) function like positional_reader's for a
+    handle that can only be read front to back, position being how far into
+    the stream it already is. Reads have to come in order, though one may
+    start inside of the last one (the tail of it is kept around), anything
+    skipped over is read and dropped.
+    """
+    # the bytes read last time and the stream offset they start at
+    last = [position, b'']
+    def read(offset, size):
+        start, data = last
+        end = start + len(data)
+        if offset < start:
+            raise ValueError('Can not read back to %d from a stream at %d' % \
+                (offset, end))
+        if offset > end:
+            skip = offset - end
+            while skip:
+                skipped = len(handle.read(min(skip, 1 << 20)))
+                if not skipped:
+                    break
+                skip -= skipped
+            data = b''
+        else:
+            data = data[offset - start:]
+        while len(data) < size:
+            more = handle.read(size - len(data))
+            if not more:
+                break
+            data += more
+        last[:] = [offset, data]
+        return data[:size]
+    return read
+
+def ordered_map(func, iterable, workers):
+    """Like map(), but func runs on a pool of worker threads with a bounded
+    window of items in flight. iterable is stepped through on the calling
+    thread as items are submitted, so any reads it does happen one at a time
+    and in order (which is what a pipe needs), while reads inside func run in
+    parallel. Results are still yielded in input order.
+    """
+    if workers < 2:
+        for item in iterable:
+            yield func(item)
+        return
+    window = collections.deque()
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        for item in iterable:
+            window.append(executor.submit(func, item))
+            if len(window) >= 2 * workers:
+                yield window.popleft().result()
+        while window:
+            yield window.popleft().result()
+    finally:
+        # a generator abandoned part way (say by an exception in the caller)
+        # gets closed by whichever thread happens to collect it, possibly one
+        # that's still starting up, so never block on the workers here
+        executor.shutdown(wait=False, cancel_futures=True)
@@ -1,11 +1,60 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
 import zlib
 import struct
+import functools
 import os
+import sys
+import stat
+import itertools
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+
+import _codec
+import _util
+try:
+    # zlib-ng's adler32 is SIMD accelerated, stock zlib's usually isn't
+    from zlib_ng.zlib_ng import adler32 as _adler32
+except ImportError:
+    _adler32 = zlib.adler32
 
 ZLIB_DEFAULT_LEVEL  = max(1, min(9, int(os.environ.get('ZLIB_DEFAULT_LEVEL', '1'))))
-ZLIB_WINDOW_SIZE = -15
+# decompressed blocks are staged and written out in chunks of this size
+WRITE_BUFFER_SIZE = 1 << 20
+
+def _range_copier(input_handle, output_handle):
+    """Build a copy(offset, size) function that appends a byte range of
+    input_handle to output_handle without passing it through userspace, or
+    return None where that isn't possible (non-files, non-Linux)
+    """
+    if not hasattr(os, 'sendfile') or not sys.platform.startswith('linux'):
+        return None
+    try:
+        in_fd = input_handle.fileno()
+        out_fd = output_handle.fileno()
+        if not (stat.S_ISREG(os.fstat(in_fd).st_mode) and \
+                stat.S_ISREG(os.fstat(out_fd).st_mode)):
+            return None
+    except (AttributeError, EnvironmentError, ValueError):
+        return None
+    def copy(offset, size):
+        output_handle.flush()
+        while size:
+            copied = os.sendfile(out_fd, in_fd, offset, size)
+            if not copied:
+                raise EOFError('Input ended while copying %d bytes at %d' % (size, offset))
+            offset += copied
+            size -= copied
+        # sendfile moved the descriptor, bring the file object back in sync
+        output_handle.seek(os.lseek(out_fd, 0, os.SEEK_CUR))
+    return copy
+
+@functools.lru_cache(maxsize=64)
+def _table_struct(item_fmt, count):
+    """Return a struct.Struct for a table of count items, cached so the same
+    format isn't rebuilt and reparsed for every file of a given size
+    """
+    return struct.Struct(item_fmt % count)
 
 class GczError(Exception): pass
 class GczHeaderError(GczError): pass
@@ -43,7 +92,7 @@ class GczHeader(object):
                 (self.magic_cookie, self.GCZ_MAGIC))
         if (self.block_size * self.num_blocks) != self.data_size:
             raise GczHeaderError('Decompressed data size does not match expected size: %d != %d' % \
-                self.block_size * self.num_blocks, self.data_size)
+                (self.block_size * self.num_blocks, self.data_size))
 
         self._load_pointers_and_hashes(handle)
 
@@ -51,114 +100,248 @@ class GczHeader(object):
     def size(self):
         return self.HEADER_STRUCT.size
 
-    @property
-    def block_pointers_size(self):
-        return struct.calcsize(self.POINTERS_STRUCT_FMT % len(self.block_pointers))
-
-    @property
-    def block_hashes_size(self):
-        return struct.calcsize(self.HASHES_STRUCT_FMT % len(self.block_hashes))
-
-    @property
-    def full_size(self):
-        return self.size + self.block_pointers_size + self.block_hashes_size
-
     def _load_pointers_and_hashes(self, handle):
-        pointers_struct = struct.Struct(self.POINTERS_STRUCT_FMT % self.num_blocks)
+        pointers_struct = _table_struct(self.POINTERS_STRUCT_FMT, self.num_blocks)
         handle.seek(self.size)
         self.block_pointers = list(pointers_struct.unpack(handle.read(pointers_struct.size)))
-        hashes_struct = struct.Struct(self.HASHES_STRUCT_FMT % self.num_blocks)
+        hashes_struct = _table_struct(self.HASHES_STRUCT_FMT, self.num_blocks)
         self.block_hashes = list(hashes_struct.unpack(handle.read(hashes_struct.size)))
 
+        # full_size is needed for every block read
+        self.block_pointers_size    = pointers_struct.size
+        self.block_hashes_size      = hashes_struct.size
+        self.full_size              = self.size + self.block_pointers_size + \
+            self.block_hashes_size
+
 class GczFile(object):
     UNCOMPRESSED_BLOCK_FLAG     = (1 << 63)
     COMPRESSED_BLOCK_BITMASK    = ~(1 << 63)
 
     def __init__(self, handle):
         self._handle = handle
+        self._read_at = _util.positional_reader(handle)
         self.header = GczHeader(handle)
+        self._build_block_tables()
 
     def __len__(self):
         return self.header.num_blocks
 
+    def _build_block_tables(self):
+        # decode every block pointer once up front
+        pointers = self.header.block_pointers
+        self._block_starts = [ptr & self.COMPRESSED_BLOCK_BITMASK for ptr in pointers]
+        block_ends = self._block_starts[1:] + [self.header.compressed_data_size]
+        self._block_sizes = [end - start for start, end in \
+            zip(self._block_starts, block_ends)]
+        self._block_uncompressed = [bool(ptr & self.UNCOMPRESSED_BLOCK_FLAG) \
+            for ptr in pointers]
+
+        # a non-increasing pointer means the tables are corrupt, fail up front
+        if self._block_sizes and min(self._block_sizes) <= 0:
+            block_num = next(i for i, size in enumerate(self._block_sizes) if size <= 0)
+            raise GczHeaderError('Block [%d] has a non-positive size: %d' % \
+                (block_num, self._block_sizes[block_num]))
+
     def get_block_size(self, block_num):
         try:
-            block_start = self.get_block_start(block_num)
+            return self._block_sizes[block_num]
         except IndexError:
             raise GczError('Illegal block number: %d' % block_num)
 
-        if block_num == (self.header.num_blocks - 1):
-            block_end = self.header.compressed_data_size
-        else:
-            block_end = self.get_block_start(block_num+1)
-
-        return block_end - block_start
-
     def get_block_start(self, block_num):
-        return self.header.block_pointers[block_num] & self.COMPRESSED_BLOCK_BITMASK
+        return self._block_starts[block_num]
 
     def get_block_is_uncompressed(self, block_num):
-        return bool(self.header.block_pointers[block_num] & self.UNCOMPRESSED_BLOCK_FLAG)
+        return self._block_uncompressed[block_num]
 
     def compute_block_hash(self, block_data):
-        return zlib.adler32(block_data) & 0xFFFFFFFF
+        return _adler32(block_data) & 0xFFFFFFFF
 
     def check_block_hash(self, block_num, block_data):
-        return self.compute_block_hash(block_data) == self.handle.block_hashes[block_num]
+        return self.compute_block_hash(block_data) == self.header.block_hashes[block_num]
 
-    def get_block(self, block_num):
+    def read_block(self, block_num):
         block_size = self.get_block_size(block_num)
         if block_size > self.header.block_size:
             raise GczError('Block [%d] larger than largest possible block size: %d > %d' % \
                 (block_num, block_size, self.header.block_size))
 
-        self._handle.seek(self.header.full_size + self.get_block_start(block_num))
-        block_data = self._handle.read(block_size)
+        return self._read_at(self.header.full_size + self.get_block_start(block_num),
+            block_size)
 
+    def verify_block(self, block_num, block_data):
         block_hash = self.compute_block_hash(block_data)
         if block_hash != self.header.block_hashes[block_num]:
             raise GczError('Hash of block [%d] is wrong: %08X != %08X' % \
                 (block_num, block_hash, self.header.block_hashes[block_num]))
 
-        if self.get_block_is_uncompressed(block_num):
-            if block_size != self.header.block_size:
+    def decode_block(self, block_num, block_data, verify=True):
+        block_size = len(block_data)
+        expected_size = self.header.block_size
+        if verify:
+            self.verify_block(block_num, block_data)
+
+        if self._block_uncompressed[block_num]:
+            if block_size != expected_size:
                 raise GczError('Uncompressed block [%d] is wrong size: %d != %d' % \
-                    (block_num, block_size, self.header.block_size))
+                    (block_num, block_size, expected_size))
         else:
-            block_data = zlib.decompress(block_data)
-            if len(block_data) != self.header.block_size:
+            try:
+                block_data = _codec.zlib_inflate(block_data, expected_size)
+            except zlib.error as err:
+                raise GczError('Block [%d] failed to decompress: %s' % (block_num, err))
+            if len(block_data) != expected_size:
                 raise GczError('Decompressed block [%d] is wrong size: %d != %d' % \
-                    (block_num, len(block_data), self.header.block_size))
+                    (block_num, len(block_data), expected_size))
 
         return block_data
 
+    def find_broken_blocks(self, parallel_workers=None):
+        # check the stored hashes only, one contiguous shard per worker
+        if parallel_workers is None:
+            parallel_workers = multiprocessing.cpu_count()
+        num_blocks = len(self)
+        shard_size = max(1, -(-num_blocks // max(1, parallel_workers)))
+        def check_shard(shard_start):
+            adler32 = _adler32
+            read_at = self._read_at
+            data_start = self.header.full_size
+            max_size = self.header.block_size
+            block_starts = self._block_starts
+            block_sizes = self._block_sizes
+            block_hashes = self.header.block_hashes
+            broken = []
+            for i in range(shard_start, min(shard_start + shard_size, num_blocks)):
+                if block_sizes[i] > max_size or block_hashes[i] != \
+                        adler32(read_at(data_start + block_starts[i], block_sizes[i])) & 0xFFFFFFFF:
+                    broken.append(i)
+            return broken
+
+        broken_blocks = []
+        shards = range(0, num_blocks, shard_size)
+        for broken in _util.ordered_map(check_shard, shards, parallel_workers):
+            broken_blocks.extend(broken)
+        return broken_blocks
+
+    def get_block(self, block_num, verify=True):
+        # read_block may hand back a view of the input, callers get a copy
+        return bytes(self.decode_block(block_num, self.read_block(block_num), verify))
+
 class GczWorker(object):
     def __init__(self):
         pass
 
 class GczDecompressor(GczWorker):
-    def decompress(self, input_handle, output_handle, observer=None, skip_broken=False):
+    def decompress(self, input_handle, output_handle, observer=None, skip_broken=False,
+            parallel_workers=None, verify=True):
         gcz_file = GczFile(input_handle)
+        if parallel_workers is None:
+            parallel_workers = multiprocessing.cpu_count()
         if observer is not None:
             observer.maxval = len(gcz_file)
             observer.start()
-        for i in xrange(len(gcz_file)):
+
+        read = gcz_file.read_block
+        decode = gcz_file.decode_block
+        verify_block = gcz_file.verify_block
+        num_blocks = len(gcz_file)
+        block_size = gcz_file.header.block_size
+        data_start = gcz_file.header.full_size
+        # hand out blocks in batches of roughly WRITE_BUFFER_SIZE bytes
+        batch_blocks = max(1, WRITE_BUFFER_SIZE // block_size)
+        # unverified uncompressed blocks can be copied by the kernel
+        copy_range = None if verify else _range_copier(input_handle, output_handle)
+        if copy_range is not None:
+            input_size = os.fstat(input_handle.fileno()).st_size
+        def can_copy(i):
+            return copy_range is not None and gcz_file.get_block_is_uncompressed(i) and \
+                gcz_file.get_block_size(i) == block_size and \
+                data_start + gcz_file.get_block_start(i) + block_size <= input_size
+
+        # errors are passed along rather than raised so that a single broken
+        # block doesn't tear down the whole pipeline
+        def read_batch(batch_start):
+            batch = []
+            for i in range(batch_start, min(batch_start + batch_blocks, num_blocks)):
+                if can_copy(i):
+                    batch.append((i, None))
+                    continue
+                try:
+                    batch.append((i, read(i)))
+                except GczError as err:
+                    batch.append((i, err))
+            return batch
+        def decode_block(i, block_data, check_hash):
+            if block_data is None or isinstance(block_data, GczError):
+                return block_data
             try:
-                block = gcz_file.get_block(i)
+                return decode(i, block_data, check_hash)
             except GczError as err:
-                if skip_broken:
-                    print err
-                    block = '\0' * gcz_file.header.block_size
+                return err
+        def check_batch(batch):
+            failed = {}
+            for i, block_data in batch:
+                if block_data is None or isinstance(block_data, GczError):
+                    continue
+                try:
+                    verify_block(i, block_data)
+                except GczError as err:
+                    failed[i] = err
+            return failed
+
+        # with a lone worker and a spare core, hash each batch on a helper
+        # thread while the worker inflates it (hash errors still win)
+        if verify and parallel_workers < 2 and multiprocessing.cpu_count() > 1:
+            hash_pool = ThreadPoolExecutor(max_workers=1)
+        else:
+            hash_pool = None
+        def decode_batch(batch_start):
+            batch = read_batch(batch_start)
+            if hash_pool is None:
+                return [decode_block(i, block_data, verify) for i, block_data in batch]
+            hashed = hash_pool.submit(check_batch, batch)
+            decoded = [decode_block(i, block_data, False) for i, block_data in batch]
+            failed = hashed.result()
+            return [failed.get(i, block) for (i, _), block in zip(batch, decoded)]
+
+        # every block comes out at exactly block_size, so stage them in fixed
+        # slots of one preallocated buffer
+        write_buffer = memoryview(bytearray(batch_blocks * block_size))
+        buffered = 0
+        write = output_handle.write
+        batches = _util.ordered_map(decode_batch, range(0, num_blocks, batch_blocks),
+            parallel_workers)
+        try:
+            for i, block in enumerate(itertools.chain.from_iterable(batches)):
+                if isinstance(block, GczError):
+                    if skip_broken:
+                        print(block)
+                        block = b'\0' * block_size
+                    else:
+                        write(write_buffer[:buffered])
+                        raise block
+                if block is None:
+                    write(write_buffer[:buffered])
+                    buffered = 0
+                    copy_range(data_start + gcz_file.get_block_start(i), block_size)
                 else:
-                    raise err
-            output_handle.write(block)
-            if observer is not None and i % 10 == 0:
-                observer.update(i)
+                    write_buffer[buffered:buffered + block_size] = block
+                    buffered += block_size
+                    if buffered == len(write_buffer):
+                        write(write_buffer)
+                        buffered = 0
+                if observer is not None and i % 10 == 0:
+                    observer.update(i)
+        finally:
+            # shut the worker pool down now, not when the generator is collected
+            batches.close()
+            if hash_pool is not None:
+                hash_pool.shutdown()
+        write(write_buffer[:buffered])
         if observer is not None:
             observer.update(len(gcz_file))
 
 if __name__ == '__main__':
-    import sys
     try:
         import progressbar
     except ImportError:
@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
 """
 Heavily based on the following code:
@@ -10,14 +10,51 @@ __author__  = 'Alex Headley <aheadley@waysaboutstuff.com>'
 __license__ = 'GPLv2'
 __version__ = '0.1'
 
-import zlib
+import math
 import struct
+import array
+import sys
 import logging
 import os
+import stat
+import mmap
+import multiprocessing
+
+import _codec
+import _util
 
 # constrain the value to 1-9
 ZLIB_DEFAULT_LEVEL  = max(1, min(9, int(os.environ.get('ZLIB_DEFAULT_LEVEL', '1'))))
-ZLIB_WINDOW_SIZE    = -15
+# decompressed blocks are staged and written out in chunks of this size
+WRITE_BUFFER_SIZE   = 1 << 20
+
+def _output_map(handle, size):
+    """Allocate and map size bytes of handle's file past its current position,
+    or return None where that isn't possible
+    """
+    if not size or not hasattr(os, 'posix_fallocate'):
+        return None
+    try:
+        fd = handle.fileno()
+        if not (handle.readable() and stat.S_ISREG(os.fstat(fd).st_mode)):
+            return None
+        offset = handle.tell()
+    except (AttributeError, EnvironmentError, ValueError):
+        return None
+    if offset % mmap.ALLOCATIONGRANULARITY:
+        return None
+    handle.flush()
+    try:
+        # a full disk has to fail here, not as a SIGBUS from the mapping
+        os.posix_fallocate(fd, offset, size)
+    except (EnvironmentError, ValueError):
+        os.ftruncate(fd, offset)
+        return None
+    try:
+        return mmap.mmap(fd, size, access=mmap.ACCESS_WRITE, offset=offset)
+    except (EnvironmentError, ValueError):
+        os.ftruncate(fd, offset)
+        return None
 
 class CisoWorker(object):
     CISO_HEADER_FMT     = ''.join([
@@ -34,52 +71,134 @@ class CisoWorker(object):
     CISO_MAGIC      = 0x4F534943 # 'CISO'
     CISO_VER        = 0x01
     CISO_BLOCK_SIZE = 0x0800
-    CISO_INDEX_FMT  = '<%dI'
+    CISO_INDEX_TYPECODE     = 'I'
+    CISO_INDEX_ENTRY_SIZE   = 0x04
 
     UNCOMPRESSED_BITMASK    = 0x80000000
     INDEX_BITMASK           = 0x7FFFFFFF
 
 assert CisoWorker.CISO_HEADER_SIZE == struct.calcsize(CisoWorker.CISO_HEADER_FMT)
+assert CisoWorker.CISO_INDEX_ENTRY_SIZE == \
+    array.array(CisoWorker.CISO_INDEX_TYPECODE).itemsize
 
 class CisoDecompressor(CisoWorker):
-    def decompress(self, input_handle, output_handle):
-        """Decompress a CSO
-        """
-        header = self._read_header(input_handle.read(self.CISO_HEADER_SIZE))
-        block_count = header['file_size'] / header['block_size']
-        index_buffer_fmt = self.CISO_INDEX_FMT % (block_count + 1)
-        index_buffer_size = struct.calcsize(index_buffer_fmt)
-        index_buffer = struct.unpack(index_buffer_fmt,
-            input_handle.read(index_buffer_size))
-
-        decompress_block = lambda i, bi: \
-            self._decompress_block(input_handle.read, i, bi,
-                header['align'], header['block_size'])
-
-        for block_i in xrange(block_count):
-            output_handle.write(decompress_block(index_buffer, block_i))
-
-    def _decompress_block(self, read, index_buffer, block_i, align, block_size):
-        index = index_buffer[block_i] & self.INDEX_BITMASK
-        compressed = not (index_buffer[block_i] & self.UNCOMPRESSED_BITMASK)
-        # read_pos = index << align
-
-        real_block_size = block_size
-        if compressed:
-            next_index = index_buffer[block_i+1] & self.INDEX_BITMASK
-            if align:
-                real_block_size = (next_index - index + 1) << align
-            else:
-                real_block_size = (next_index - index) << align
-
-        block = read(real_block_size)
-        # block = read(real_block_size, read_pos)
+    # number of consecutive blocks to fetch per read, about 1MB of input
+    READ_GROUP_BLOCKS       = 512
 
-        if not compressed:
-            return block
+    def decompress(self, input_handle, output_handle, parallel_workers=None):
+        """Decompress a CSO"""
+        header = self._read_header(input_handle.read(self.CISO_HEADER_SIZE))
+        block_count = header['file_size'] // header['block_size']
+        # load the index into a packed array rather than a tuple of ints
+        index_buffer = array.array(self.CISO_INDEX_TYPECODE,
+            input_handle.read(self.CISO_INDEX_ENTRY_SIZE * (block_count + 1)))
+        if sys.byteorder != 'little':
+            index_buffer.byteswap()
+        if parallel_workers is None:
+            parallel_workers = multiprocessing.cpu_count()
+
+        groups = self._group_index(index_buffer, header['align'],
+            header['block_size'])
+
+        read_group = self._read_group
+        inflate = _codec.inflate
+        block_size = header['block_size']
+        if input_handle.seekable():
+            read_at = _util.positional_reader(input_handle)
+            tasks = groups
+            read_batch = lambda group: read_group(read_at, group)
+        else:
+            # a pipe can only be read front to back, so read it here in order
+            read_at = _util.sequential_reader(input_handle,
+                self.CISO_HEADER_SIZE + len(index_buffer) * self.CISO_INDEX_ENTRY_SIZE)
+            tasks = (read_group(read_at, group) for group in groups)
+            read_batch = lambda batch: batch
+        def decompress_batch(task):
+            batch = read_batch(task)
+            return [inflate(block, block_size) if compressed else block
+                for compressed, block in batch]
+
+        # the mapping only pays off with several workers filling it at once
+        output_size = block_count * block_size
+        output_map = _output_map(output_handle, output_size) \
+            if parallel_workers > 1 else None
+        if output_map is not None:
+            # every group lands straight in its own slice of the output
+            group_size = self.READ_GROUP_BLOCKS * block_size
+            def decompress_into(task_info):
+                write_pos, task = task_info
+                for block in decompress_batch(task):
+                    output_map[write_pos:write_pos + len(block)] = block
+                    write_pos += block_size
+            try:
+                for _ in _util.ordered_map(decompress_into,
+                        ((task_i * group_size, task)
+                            for task_i, task in enumerate(tasks)),
+                        parallel_workers):
+                    pass
+            except BaseException:
+                output_map.close()
+                # don't leave a full size, partly zero filled image behind
+                output_handle.truncate()
+                raise
+            output_map.close()
+            # nothing went through the handle, move it past the output
+            output_handle.seek(output_size, os.SEEK_CUR)
+            return
+
+        write_buffer = bytearray()
+        buffer_block = write_buffer.extend
+        write = output_handle.write
+        for batch in _util.ordered_map(decompress_batch, tasks, parallel_workers):
+            for block in batch:
+                buffer_block(block)
+            if len(write_buffer) >= WRITE_BUFFER_SIZE:
+                write(write_buffer)
+                del write_buffer[:]
+        write(write_buffer)
+
+    def _decode_index(self, index_buffer, align, block_size):
+        """Decode a run of index entries (plus the entry that follows it) into
+        the read offset, read size and compressed flag of each block
+        """
+        INDEX = self.INDEX_BITMASK
+        UNCOMPRESSED = self.UNCOMPRESSED_BITMASK
+        indexes = [index & INDEX for index in index_buffer]
+        compressed = [not (index & UNCOMPRESSED) for index in index_buffer[:-1]]
+        block_bounds = zip(indexes, indexes[1:], compressed)
+        if align:
+            offsets = [index << align for index in indexes[:-1]]
+            # the last block of an aligned image can run past the final index
+            # entry, so read an extra alignment unit
+            sizes = [((next_index - index + 1) << align) if block_compressed \
+                    else block_size
+                for index, next_index, block_compressed in block_bounds]
         else:
-            # TODO: error handling here
-            return zlib.decompress(block, ZLIB_WINDOW_SIZE)
+            # unaligned images (anything under 2GB) index by byte offset, so
+            # skip the no-op shifts
+            offsets = indexes[:-1]
+            sizes = [(next_index - index) if block_compressed else block_size
+                for index, next_index, block_compressed in block_bounds]
+        return offsets, sizes, compressed
+
+    def _group_index(self, index_buffer, align, block_size):
+        # decode the index one worker batch of READ_GROUP_BLOCKS at a time
+        group_size = self.READ_GROUP_BLOCKS
+        block_count = len(index_buffer) - 1
+        for group_start in range(0, block_count, group_size):
+            group_end = min(group_start + group_size, block_count)
+            yield list(zip(*self._decode_index(
+                index_buffer[group_start:group_end + 1], align, block_size)))
+
+    def _read_group(self, read_at, group):
+        # blocks are stored back to back, so fetch the run with a single read
+        chunk_start = min(read_pos for read_pos, _, _ in group)
+        chunk_end = max(read_pos + real_block_size \
+            for read_pos, real_block_size, _ in group)
+        chunk = memoryview(read_at(chunk_start, chunk_end - chunk_start))
+        return [(block_compressed,
+                chunk[read_pos - chunk_start:read_pos - chunk_start + real_block_size])
+            for read_pos, real_block_size, block_compressed in group]
 
     def _read_header(self, header_bytes):
         header_struct = struct.unpack(self.CISO_HEADER_FMT,
@@ -101,6 +220,8 @@ class CisoCompressor(CisoWorker):
     PADDING_BYTE            = b'X'
     COMPRESSION_THRESHOLD   = 90
     COMPRESSION_LEVEL       = ZLIB_DEFAULT_LEVEL
+    # number of blocks to read from the input at once, 1MB
+    READ_CHUNK_BLOCKS       = 512
 
     def __init__(self, level=COMPRESSION_LEVEL, threshold=COMPRESSION_THRESHOLD,
             padding_byte=PADDING_BYTE):
@@ -108,9 +229,9 @@ class CisoCompressor(CisoWorker):
         self.COMPRESSION_THRESHOLD = threshold
         self.PADDING_BYTE = padding_byte
 
-    def compress(self, input_handle, output_handle, level=ZLIB_DEFAULT_LEVEL):
-        """Compress a ISO into a CSO
-        """
+    def compress(self, input_handle, output_handle, level=ZLIB_DEFAULT_LEVEL,
+            parallel_workers=None):
+        """Compress a ISO into a CSO"""
         file_size = self._get_stream_size(input_handle)
         if file_size >= 2 ** 31:
             align = 1
@@ -119,46 +240,116 @@ class CisoCompressor(CisoWorker):
         header = self._build_header(file_size, self.CISO_BLOCK_SIZE, align)
         output_handle.write(header)
 
-        block_count = file_size / self.CISO_BLOCK_SIZE
-        index_buffer = [0] * (block_count + 1)
-        output_handle.write(b'\x00\x00\x00\x00' * len(index_buffer))
-        compress_block = lambda write_pos: self._compress_block(input_handle.read,
-            write_pos, self.COMPRESSION_THRESHOLD, level, align, self.CISO_BLOCK_SIZE)
-        for block_i in xrange(block_count):
-            index, block = compress_block(output_handle.tell())
-            index_buffer[block_i] = index
-            output_handle.write(block)
-        index_buffer[-1] = output_handle.tell() >> align
-
-        output_handle.seek(self.CISO_HEADER_SIZE)
-        output_handle.write(struct.pack(self.CISO_INDEX_FMT % len(index_buffer),
-            *index_buffer))
-
-    def _compress_block(self, read, write_pos, threshold, level, align, block_size):
-        uncompressed_block = read(block_size)
-        # TODO: error handling here
-        compressed_block = zlib.compress(uncompressed_block, level)[2:]
-        padding = self._get_align_padding(write_pos, align)
-        index = (write_pos + len(padding)) >> align
-        if (100 * len(compressed_block)) / len(uncompressed_block) >= threshold:
-            block = uncompressed_block
-            index |= self.UNCOMPRESSED_BITMASK
-        elif index & self.UNCOMPRESSED_BITMASK:
-            raise Exception('Align error')
+        block_count = file_size // self.CISO_BLOCK_SIZE
+        # packed the same way it's stored, so it can be written out as-is
+        index_buffer = array.array(self.CISO_INDEX_TYPECODE, [0]) * (block_count + 1)
+        output_handle.write(index_buffer)
+        if parallel_workers is None:
+            parallel_workers = multiprocessing.cpu_count()
+
+        # the threshold ratio as the size compressed blocks have to come under
+        max_compressed_len = int(math.ceil(
+            self.COMPRESSION_THRESHOLD * self.CISO_BLOCK_SIZE / 100.0))
+
+        # only the placement of blocks has to happen in order
+        read_chunk = self._read_chunk
+        read_at = _util.positional_reader(input_handle)
+        block_size = self.CISO_BLOCK_SIZE
+        compress_batch = lambda chunk: self._compress_batch(
+            read_chunk(read_at, chunk, block_size), max_compressed_len, level)
+        chunk_blocks = self.READ_CHUNK_BLOCKS
+        chunks = ((chunk_start, min(chunk_blocks, block_count - chunk_start))
+            for chunk_start in range(0, block_count, chunk_blocks))
+
+        write_buffer = bytearray()
+        buffer_block = write_buffer.extend
+        write = output_handle.write
+        if align:
+            # padding for each of the 1 << align offsets into an alignment unit
+            align_mask = (1 << align) - 1
+            paddings = [self.PADDING_BYTE * (-remainder & align_mask)
+                for remainder in range(align_mask + 1)]
+            place_batch = lambda batch, block_i, write_pos: self._place_batch(
+                batch, block_i, write_pos, index_buffer, buffer_block, align,
+                paddings)
         else:
-            block = compressed_block
-        return index, padding + block
-
-    def _zlib_compress(self, data, level):
-        return zlib.compress(data, level)[2:]
+            place_batch = lambda batch, block_i, write_pos: \
+                self._place_batch_unaligned(batch, block_i, write_pos,
+                    index_buffer, buffer_block)
+        # the handle's position would miss whatever is still in write_buffer
+        write_pos = output_handle.tell()
+        block_i = 0
+        for batch in _util.ordered_map(compress_batch, chunks, parallel_workers):
+            write_pos = place_batch(batch, block_i, write_pos)
+            block_i += len(batch)
+            if len(write_buffer) >= WRITE_BUFFER_SIZE:
+                write(write_buffer)
+                del write_buffer[:]
+        write(write_buffer)
+        index_buffer[-1] = write_pos >> align
+
+        if sys.byteorder != 'little':
+            index_buffer.byteswap()
+        output_handle.seek(self.CISO_HEADER_SIZE)
+        output_handle.write(index_buffer)
 
-    def _get_align_padding(self, write_pos, align):
-        align_shift = 1 << align
-        if write_pos % align_shift:
-            padding = PADDING_BYTE * (align_shift - write_pos % align_shift)
-        else:
-            padding = ''
-        return padding
+    def _place_batch(self, batch, block_i, write_pos, index_buffer, buffer_block,
+            align, paddings):
+        """Index and stage a batch of blocks, returning the next write position
+        """
+        UNCOMPRESSED = self.UNCOMPRESSED_BITMASK
+        align_mask = len(paddings) - 1
+        for compressed, block in batch:
+            padding = paddings[write_pos & align_mask]
+            write_pos += len(padding)
+            index = write_pos >> align
+            if not compressed:
+                index |= UNCOMPRESSED
+            elif index & UNCOMPRESSED:
+                raise Exception('Align error')
+            index_buffer[block_i] = index
+            block_i += 1
+            write_pos += len(block)
+            if padding:
+                buffer_block(padding)
+            buffer_block(block)
+        return write_pos
+
+    def _place_batch_unaligned(self, batch, block_i, write_pos, index_buffer,
+            buffer_block):
+        UNCOMPRESSED = self.UNCOMPRESSED_BITMASK
+        for compressed, block in batch:
+            if not compressed:
+                index_buffer[block_i] = write_pos | UNCOMPRESSED
+            elif write_pos & UNCOMPRESSED:
+                raise Exception('Align error')
+            else:
+                index_buffer[block_i] = write_pos
+            block_i += 1
+            write_pos += len(block)
+            buffer_block(block)
+        return write_pos
+
+    def _read_chunk(self, read_at, chunk, block_size):
+        # one read per chunk, split into views of the (usually mmapped) input
+        chunk_start, chunk_count = chunk
+        chunk_size = chunk_count * block_size
+        data = memoryview(read_at(chunk_start * block_size, chunk_size))
+        return [data[offset:offset + block_size]
+            for offset in range(0, chunk_size, block_size)]
+
+    def _compress_batch(self, blocks, max_compressed_len, level):
+        deflate = _codec.deflate
+        results = []
+        append = results.append
+        for uncompressed_block in blocks:
+            compressed_block = deflate(uncompressed_block, level,
+                max_compressed_len)
+            if compressed_block is None:
+                append((False, uncompressed_block))
+            else:
+                append((True, compressed_block))
+        return results
 
     def _get_stream_size(self, stream):
         current_pos = stream.tell()
@@ -178,16 +369,16 @@ class CisoCompressor(CisoWorker):
             0
         )
 
-def decompress(input_handle, output_handle):
+def decompress(input_handle, output_handle, parallel_workers=None):
     worker = CisoDecompressor()
-    return worker.decompress(input_handle, output_handle)
+    return worker.decompress(input_handle, output_handle, parallel_workers)
 
-def compress(input_handle, output_handle, level=ZLIB_DEFAULT_LEVEL):
+def compress(input_handle, output_handle, level=ZLIB_DEFAULT_LEVEL,
+        parallel_workers=None):
     worker = CisoCompressor(level)
-    return worker.compress(input_handle, output_handle, level)
+    return worker.compress(input_handle, output_handle, level, parallel_workers)
 
 if __name__ == '__main__':
-    import sys
     import optparse
 
     parser = optparse.OptionParser()
@@ -197,16 +388,19 @@ if __name__ == '__main__':
     parser.add_option('-l', '--level',
         action='store', type='int', default=ZLIB_DEFAULT_LEVEL,
         help='Compression level to use (1-9)')
+    parser.add_option('-t', '--threads',
+        action='store', type='int', default=None,
+        help='Number of threads to use (defaults to CPU count)')
 
     opts, args = parser.parse_args()
 
     if opts.decompress:
-        worker = lambda i, o: decompress(i, o)
+        worker = lambda i, o: decompress(i, o, opts.threads)
     else:
-        worker = lambda i, o: compress(i, o, opts.level)
+        worker = lambda i, o: compress(i, o, opts.level, opts.threads)
 
     if len(args) == 0:
-        worker(sys.stdin, sys.stdout)
+        worker(sys.stdin.buffer, sys.stdout.buffer)
     else:
         if len(args) == 1:
             in_filename = args[0]
@@ -228,5 +422,6 @@ if __name__ == '__main__':
             in_filename = args[0]
             out_filename = args[1]
         with open(in_filename, 'rb') as in_file:
-            with open(out_filename, 'wb') as out_file:
+            # opened for reading too so the decompressor can map the output
+            with open(out_filename, 'w+b') as out_file:
                 worker(in_file, out_file)